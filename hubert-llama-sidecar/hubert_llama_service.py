@@ -14,17 +14,21 @@ Based on SpeakLlama architecture but customized for Heilion's tutoring use case.
 
 import asyncio
 import websockets
-import json
+import orjson
 import sys
 import os
 import tempfile
+import threading
+import importlib.util
 import wave
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Check dependencies
 HUBERT_AVAILABLE = False
 LLAMA_AVAILABLE = False
+LLAMA_CPP_AVAILABLE = False
 
 try:
     import torch
@@ -33,7 +37,8 @@ try:
         Wav2Vec2Model,
         AutoTokenizer,
         AutoModelForCausalLM,
-        BitsAndBytesConfig
+        GPTQConfig,
+        TextIteratorStreamer
     )
     HUBERT_AVAILABLE = True
     print("✓ Transformers libraries loaded")
@@ -42,22 +47,56 @@ except ImportError as e:
     print("  Install with: pip install transformers torch")
 
 try:
-    import librosa
     import soundfile
+    import torchaudio
     print("✓ Audio processing libraries loaded")
 except ImportError as e:
     print(f"⚠ Audio libraries not available: {e}")
-    print("  Install with: pip install librosa soundfile")
+    print("  Install with: pip install soundfile torchaudio")
+
+try:
+    from llama_cpp import Llama
+    LLAMA_CPP_AVAILABLE = True
+    print("✓ llama.cpp bindings loaded")
+except ImportError as e:
+    print(f"⚠ llama.cpp bindings not available: {e}")
+    print("  Install with: pip install llama-cpp-python")
 
 # Model configuration
 HUBERT_MODEL_NAME = "facebook/hubert-large-ls960-ft"  # Pre-trained HuBERT for speech
-LLAMA_MODEL_NAME = "meta-llama/Llama-3-8B-Instruct"  # Llama 3 8B Instruct
-USE_4BIT = True  # Use 4-bit quantization to fit in memory
+LLAMA_MODEL_NAME = "meta-llama/Llama-3-8B-Instruct"  # Llama 3 8B Instruct (CPU fallback)
+LLAMA_GPTQ_MODEL_NAME = "hugging-quants/Meta-Llama-3-8B-Instruct-GPTQ-INT4"  # Pre-quantized for CUDA
+USE_4BIT = True  # Use 4-bit GPTQ weights on CUDA to fit in memory
+LLAMA_GGUF_PATH = os.environ.get("LLAMA_GGUF_PATH", "Meta-Llama-3-8B-Instruct.Q4_K_M.gguf")  # llama.cpp weights
+LLAMA_BACKEND = os.environ.get("LLAMA_BACKEND", "auto")  # auto | llama_cpp | transformers
+LLAMA_CTX_SIZE = 8192  # Llama 3's full context window
+MAX_NEW_TOKENS = 512
+
+# Invariant parts of the Llama 3 prompt (tokenized once at model load)
+STATIC_SYSTEM_PROMPT = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+
+You are an AI tutor helping a student. The student's speech has been encoded using HuBERT speech encoder. 
+Process the speech information and respond naturally as a tutor.
+
+"""
+PROMPT_SUFFIX = """Please transcribe and understand the student's speech, then respond as a helpful tutor.
+
+<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+
+"""
 
 # Audio settings (matching Whisper/whisper.cpp requirements)
 SAMPLE_RATE = 16000
 CHUNK_DURATION = 30.0  # 30 second chunks (standard for speech models)
 
+# Micro-batching of concurrent transcribe requests
+MAX_BATCH_SIZE = 8
+MAX_BATCH_LATENCY = 0.05  # Seconds to wait for more requests before running a batch
+
+def to_json(message):
+    """Serialize a message for a WebSocket text frame"""
+    return orjson.dumps(message).decode()
+
 class HubertLlamaService:
     """HuBERT + Llama 3 speech understanding service"""
     
@@ -67,12 +106,38 @@ class HubertLlamaService:
         self.huber_processor = None
         self.llama_model = None
         self.llama_tokenizer = None
+        self.use_llama_cpp = False
+        self._prefix_ids = []
+        self._suffix_ids = []
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.models_loaded = False
+        self.request_queue = None
+        self.batch_task = None
+        # All model calls (warmup and batches) run on this one thread: CUDA graphs
+        # captured by torch.compile's reduce-overhead mode are tied to the capturing thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        
+        # Reusable 30s input buffer, one row per batch slot (avoids a fresh pad/alloc per request).
+        # Allocated once in pinned host memory on CUDA; _audio_buf is a NumPy view of the
+        # same memory, so audio is decoded straight into the H2D staging buffer.
+        target_length = int(SAMPLE_RATE * CHUNK_DURATION)
+        self._pinned = torch.zeros(
+            (MAX_BATCH_SIZE, target_length),
+            dtype=torch.float32,
+            pin_memory=(self.device == "cuda")
+        )
+        self._audio_buf = self._pinned.numpy()
+        self._h2d_done = None  # CUDA event marking the last async copy out of _pinned
         
         print(f"🚀 HuBERT + Llama 3 Service initializing...")
         print(f"   Device: {self.device}")
     
+    def attn_implementation(self):
+        """FlashAttention-2 when installed on CUDA, otherwise PyTorch's fused SDPA"""
+        if self.device == "cuda" and importlib.util.find_spec("flash_attn") is not None:
+            return "flash_attention_2"
+        return "sdpa"
+    
     async def load_models(self):
         """Load HuBERT and Llama 3 models"""
         if self.models_loaded:
@@ -82,39 +147,93 @@ class HubertLlamaService:
             print("📦 Loading HuBERT model...")
             # Load HuBERT for speech encoding
             self.huber_processor = Wav2Vec2Processor.from_pretrained(HUBERT_MODEL_NAME)
-            self.huber_model = Wav2Vec2Model.from_pretrained(HUBERT_MODEL_NAME)
-            self.huber_model.to(self.device)
-            self.huber_model.eval()
+            if self.device == "cuda":
+                # FP16 halves bandwidth and uses Tensor Cores; compile fuses the encoder layers
+                self.huber_model = Wav2Vec2Model.from_pretrained(
+                    HUBERT_MODEL_NAME,
+                    torch_dtype=torch.float16
+                ).to(self.device).eval()
+                self.huber_model = torch.compile(
+                    self.huber_model,
+                    mode="reduce-overhead",
+                    fullgraph=True
+                )
+            else:
+                self.huber_model = Wav2Vec2Model.from_pretrained(HUBERT_MODEL_NAME)
+                self.huber_model.to(self.device)
+                self.huber_model.eval()
             print("✓ HuBERT loaded")
             
             print("📦 Loading Llama 3 (8B) model...")
-            # Configure quantization for memory efficiency
-            if USE_4BIT and self.device == "cpu":
-                quantization_config = BitsAndBytesConfig(
-                    load_in_4bit=True,
-                    bnb_4bit_compute_dtype=torch.float16
+            # llama.cpp (GGUF q4_K_M, SIMD kernels) is the fast path on CPU;
+            # it can also be forced on CUDA with full layer offload
+            if LLAMA_BACKEND == "auto":
+                self.use_llama_cpp = (
+                    LLAMA_CPP_AVAILABLE
+                    and self.device == "cpu"
+                    and os.path.exists(LLAMA_GGUF_PATH)
                 )
             else:
-                quantization_config = None
-            
-            # Load Llama 3 tokenizer and model
-            self.llama_tokenizer = AutoTokenizer.from_pretrained(LLAMA_MODEL_NAME)
-            if self.llama_tokenizer.pad_token is None:
-                self.llama_tokenizer.pad_token = self.llama_tokenizer.eos_token
-            
-            self.llama_model = AutoModelForCausalLM.from_pretrained(
-                LLAMA_MODEL_NAME,
-                quantization_config=quantization_config,
-                device_map="auto" if self.device == "cuda" else None,
-                torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                trust_remote_code=True
-            )
+                self.use_llama_cpp = LLAMA_BACKEND == "llama_cpp"
             
-            if self.device == "cpu" and quantization_config is None:
-                self.llama_model.to(self.device)
+            if self.use_llama_cpp:
+                self.llama_model = Llama(
+                    model_path=LLAMA_GGUF_PATH,
+                    n_ctx=LLAMA_CTX_SIZE,
+                    n_gpu_layers=-1 if self.device == "cuda" else 0,
+                    n_threads=os.cpu_count(),
+                    verbose=False
+                )
+                print("✓ Llama 3 (8B) loaded (llama.cpp)")
+            else:
+                # Pre-quantized GPTQ weights on CUDA (fused dequant+matmul kernels).
+                # bitsandbytes 4-bit needs CUDA and is slower than FP16 for decode,
+                # so CPU falls back to the unquantized model.
+                if USE_4BIT and self.device == "cuda":
+                    model_name = LLAMA_GPTQ_MODEL_NAME
+                    quantization_config = GPTQConfig(bits=4, use_exllama=True)
+                else:
+                    model_name = LLAMA_MODEL_NAME
+                    quantization_config = None
+                
+                # Load Llama 3 tokenizer and model
+                self.llama_tokenizer = AutoTokenizer.from_pretrained(model_name)
+                if self.llama_tokenizer.pad_token is None:
+                    self.llama_tokenizer.pad_token = self.llama_tokenizer.eos_token
+                
+                # accelerate's dispatch hooks are only needed to split the model across
+                # GPUs; a single-device map loads straight onto the GPU without them
+                if self.device == "cuda" and torch.cuda.device_count() > 1:
+                    device_map = "auto"
+                elif self.device == "cuda":
+                    device_map = {"": torch.cuda.current_device()}
+                else:
+                    device_map = None
+                
+                self.llama_model = AutoModelForCausalLM.from_pretrained(
+                    model_name,
+                    quantization_config=quantization_config,
+                    device_map=device_map,
+                    torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
+                    attn_implementation=self.attn_implementation(),
+                    low_cpu_mem_usage=True
+                )
+                
+                if self.device == "cpu":
+                    self.llama_model.to(self.device)
+                
+                self.llama_model.eval()
+                
+                # Preallocated KV cache (no per-step growth). Older transformers
+                # releases reject the static cache under FlashAttention-2.
+                if self.llama_model.config._attn_implementation != "flash_attention_2":
+                    self.llama_model.generation_config.cache_implementation = "static"
+                
+                print(f"✓ Llama 3 (8B) loaded ({self.llama_model.config._attn_implementation} attention)")
             
-            self.llama_model.eval()
-            print("✓ Llama 3 (8B) loaded")
+            # Tokenize the invariant parts of the prompt once
+            self._prefix_ids = self.tokenize_prompt(STATIC_SYSTEM_PROMPT)
+            self._suffix_ids = self.tokenize_prompt(PROMPT_SUFFIX)
             
             self.models_loaded = True
             return True
@@ -127,139 +246,430 @@ class HubertLlamaService:
             print(f"   3. All dependencies installed")
             return False
     
-    def encode_audio_hubert(self, audio_path):
+    def encode_audio_hubert(self, audio_paths):
         """
-        Encode audio using HuBERT to extract speech representations
+        Encode a batch of audio files using HuBERT to extract speech representations
+        
+        Clips that can't be read are left out of the forward pass and reported in
+        errors, so one bad file doesn't fail the other requests in its batch.
         
         Returns:
-            speech_tokens: Encoded speech tokens/embeddings
-            speech_features: Raw feature vectors
+            speech_shape: Shape [batch, frames, hidden_dim] of the HuBERT hidden states
+                for the clips that loaded (None if none did). The prompt is text-only,
+                so the features are never copied back to the host (a learned adapter
+                would project them into Llama's embedding space on the device).
+            errors: Dict mapping the index in audio_paths of each unreadable clip to its exception
         """
+        # Don't overwrite the pinned buffer while the previous copy may still be reading it
+        if self._h2d_done is not None:
+            self._h2d_done.synchronize()
+        
+        errors = {}
+        rows = 0
+        for i, audio_path in enumerate(audio_paths):
+            try:
+                self.load_audio_row(rows, audio_path)
+                rows += 1
+            except Exception as e:
+                print(f"Error loading audio {audio_path}: {e}")
+                errors[i] = e
+        
+        if rows == 0:
+            return None, errors
+        
         try:
-            # Load and preprocess audio
-            audio, sr = librosa.load(audio_path, sr=SAMPLE_RATE)
-            
-            # Pad or trim to 30 seconds
-            target_length = int(SAMPLE_RATE * CHUNK_DURATION)
-            if len(audio) > target_length:
-                audio = audio[:target_length]
-            else:
-                padding = target_length - len(audio)
-                audio = np.pad(audio, (0, padding), mode='constant')
-            
-            # Process with HuBERT
-            inputs = self.huber_processor(
-                audio,
-                sampling_rate=SAMPLE_RATE,
-                return_tensors="pt",
-                padding=True
-            ).to(self.device)
-            
-            # Extract features
-            with torch.no_grad():
-                outputs = self.huber_model(**inputs)
-                # Use hidden states (last layer or average of layers)
-                speech_features = outputs.last_hidden_state
-                
-                # Convert to discrete tokens (quantization for Llama compatibility)
-                # Average pooling to reduce sequence length
-                speech_tokens = torch.mean(speech_features, dim=1)  # [batch, hidden_dim]
-            
-            return speech_tokens.cpu().numpy(), speech_features.cpu().numpy()
-            
+            return self.run_hubert(rows), errors
         except Exception as e:
             print(f"Error encoding audio with HuBERT: {e}")
             raise
     
-    def create_speech_prompt(self, speech_tokens, context=""):
+    def load_audio_row(self, row, audio_path):
+        """Load a clip straight into a row of the reusable 30s buffer (pad/trim in place)"""
+        audio, sr = soundfile.read(audio_path, dtype='float32', always_2d=False)
+        if audio.ndim > 1:
+            audio = audio.mean(axis=1)  # Downmix to mono
+        if sr != SAMPLE_RATE:
+            # Clients send 16kHz WAV; only resample the odd file out
+            audio = torchaudio.functional.resample(
+                torch.from_numpy(audio).to(self.device),
+                sr,
+                SAMPLE_RATE
+            ).cpu().numpy()
+        n = min(len(audio), self._audio_buf.shape[1])
+        self._audio_buf[row, :n] = audio[:n]
+        self._audio_buf[row, n:] = 0
+    
+    def run_hubert(self, batch_size):
+        """
+        Normalize the first batch_size rows of the audio buffer and run the HuBERT forward pass
+        
+        Returns:
+            speech_shape: Shape [batch, frames, hidden_dim] of the HuBERT hidden states
+        """
+        audio_buf = self._audio_buf[:batch_size]
+        
+        # Zero-mean/unit-variance normalize in place, as the processor's feature
+        # extractor would, so the processor (and its extra copies) can be skipped
+        if self.huber_processor.feature_extractor.do_normalize:
+            mean = audio_buf.mean(axis=1, keepdims=True)
+            std = np.sqrt(audio_buf.var(axis=1, keepdims=True) + 1e-7)
+            np.subtract(audio_buf, mean, out=audio_buf)
+            np.divide(audio_buf, std, out=audio_buf)
+        
+        # The buffer already lives in pinned memory, so the H2D copy is async and copy-free on the host
+        input_values = self._pinned[:batch_size].to(self.device, non_blocking=True)
+        if self.device == "cuda":
+            self._h2d_done = torch.cuda.Event()
+            self._h2d_done.record()
+            input_values = input_values.half()
+        inputs = {'input_values': input_values}
+        
+        # Extract features for the whole batch in one forward pass
+        with torch.inference_mode():
+            outputs = self.huber_model(**inputs)
+            # Use hidden states (last layer or average of layers)
+            speech_features = outputs.last_hidden_state
+        
+        return tuple(speech_features.shape)
+    
+    def tokenize_prompt(self, text):
+        """Tokenize prompt text (special tokens included, no BOS added)"""
+        if self.use_llama_cpp:
+            return self.llama_model.tokenize(
+                text.encode('utf-8'),
+                add_bos=False,
+                special=True
+            )
+        return self.llama_tokenizer(text, add_special_tokens=False).input_ids
+    
+    def create_speech_prompt(self, speech_len, context=""):
         """
-        Create a prompt for Llama 3 that includes speech information
+        Create the token IDs of a Llama 3 prompt that includes speech information
         
         We'll use a text-based representation approach where we:
         1. Describe the speech tokens in text format
         2. Or use a learned adapter to convert tokens directly
+        
+        Only the per-request part is tokenized here; the static system header
+        and assistant turn are cached from load_models.
         """
         # For now, use a text-based approach
         # In a full implementation, you'd have a learned adapter layer
         
-        prompt = f"""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
-
-You are an AI tutor helping a student. The student's speech has been encoded using HuBERT speech encoder. 
-Process the speech information and respond naturally as a tutor.
-
-{context}
+        user_prompt = f"""
 
 <|eot_id|><|start_header_id|>user<|end_header_id|>
 
-[Speech encoded with HuBERT - {len(speech_tokens)} features extracted]
-Please transcribe and understand the student's speech, then respond as a helpful tutor.
-
-<|eot_id|><|start_header_id|>assistant<|end_header_id|>
-
+[Speech encoded with HuBERT - {speech_len} features extracted]
 """
-        return prompt
+        user_ids = self.tokenize_prompt(user_prompt)
+        
+        # Context is client-supplied and unbounded; keep its most recent tokens so the
+        # prompt plus the response always fit in the context window
+        context_ids = self.tokenize_prompt(context) if context else []
+        budget = LLAMA_CTX_SIZE - MAX_NEW_TOKENS - len(self._prefix_ids) - len(self._suffix_ids) - len(user_ids)
+        if len(context_ids) > budget:
+            context_ids = context_ids[len(context_ids) - max(budget, 0):]
+        
+        return self._prefix_ids + context_ids + user_ids + self._suffix_ids
+    
+    def prompt_inputs(self, prompt_ids):
+        """Left-pad a batch of prompt token IDs into generate() inputs on the device"""
+        max_len = max(len(ids) for ids in prompt_ids)
+        input_ids = torch.full(
+            (len(prompt_ids), max_len),
+            self.llama_tokenizer.pad_token_id,
+            dtype=torch.long
+        )
+        attention_mask = torch.zeros_like(input_ids)
+        for i, ids in enumerate(prompt_ids):
+            input_ids[i, max_len - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, max_len - len(ids):] = 1
+        
+        return {
+            'input_ids': input_ids.to(self.device),
+            'attention_mask': attention_mask.to(self.device)
+        }
     
-    async def transcribe_and_understand(self, audio_path, context=""):
+    def sampling_kwargs(self, greedy=False):
+        """Decoding settings; greedy skips the per-step top-p sort for deterministic replies"""
+        if self.use_llama_cpp:
+            if greedy:
+                return {'temperature': 0.0}
+            return {'temperature': 0.7, 'top_p': 0.9}
+        
+        if greedy:
+            return {'do_sample': False, 'num_beams': 1}
+        return {'do_sample': True, 'temperature': 0.7, 'top_p': 0.9}
+    
+    def generate_responses(self, prompt_ids, greedy=False, max_new_tokens=MAX_NEW_TOKENS):
+        """Run Llama 3 on a batch of prompt token IDs and return the generated texts"""
+        if self.use_llama_cpp:
+            # llama.cpp decodes one sequence at a time
+            responses = []
+            for ids in prompt_ids:
+                output = self.llama_model(
+                    ids,
+                    max_tokens=max_new_tokens,
+                    stop=["<|eot_id|>"],
+                    **self.sampling_kwargs(greedy)
+                )
+                responses.append(output['choices'][0]['text'])
+            return responses
+        
+        # Left-padded so every sequence in the batch ends at the generation position
+        inputs = self.prompt_inputs(prompt_ids)
+        
+        with torch.inference_mode():
+            outputs = self.llama_model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                use_cache=True,
+                pad_token_id=self.llama_tokenizer.pad_token_id,
+                **self.sampling_kwargs(greedy)
+            )
+        
+        return self.llama_tokenizer.batch_decode(
+            outputs[:, inputs['input_ids'].shape[1]:],
+            skip_special_tokens=True
+        )
+    
+    def generate_streaming(self, prompt_ids, on_partial, greedy=False):
         """
-        Main function: Audio → HuBERT → Llama 3 → Text
+        Run Llama 3 on a single prompt's token IDs, passing each decoded text chunk to
+        on_partial as soon as it is available. Returns the full generated text.
+        """
+        chunks = []
+        
+        if self.use_llama_cpp:
+            for output in self.llama_model(
+                prompt_ids,
+                max_tokens=MAX_NEW_TOKENS,
+                stop=["<|eot_id|>"],
+                stream=True,
+                **self.sampling_kwargs(greedy)
+            ):
+                chunk = output['choices'][0]['text']
+                if chunk:
+                    chunks.append(chunk)
+                    on_partial(chunk)
+            return ''.join(chunks)
+        
+        inputs = self.prompt_inputs([prompt_ids])
+        streamer = TextIteratorStreamer(
+            self.llama_tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True
+        )
+        errors = []
+        
+        def run_generate():
+            try:
+                with torch.inference_mode():
+                    self.llama_model.generate(
+                        **inputs,
+                        max_new_tokens=MAX_NEW_TOKENS,
+                        use_cache=True,
+                        pad_token_id=self.llama_tokenizer.pad_token_id,
+                        streamer=streamer,
+                        **self.sampling_kwargs(greedy)
+                    )
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # Always unblock the consumer loop, even if generate() failed
+                streamer.end()
+        
+        thread = threading.Thread(target=run_generate)
+        thread.start()
+        for chunk in streamer:
+            if chunk:
+                chunks.append(chunk)
+                on_partial(chunk)
+        thread.join()
+        if errors:
+            raise errors[0]
+        
+        return ''.join(chunks)
+    
+    def generate_isolated(self, prompt_ids, greedy=False):
+        """
+        generate_responses() for a batch, isolating failures so one bad prompt only
+        fails its own request. Failed entries are returned as the exception raised.
+        """
+        if not self.use_llama_cpp:
+            try:
+                return self.generate_responses(prompt_ids, greedy=greedy)
+            except Exception as e:
+                if len(prompt_ids) == 1:
+                    return [e]
+                print(f"Batched generation failed ({e}), retrying prompts one at a time")
+        
+        outputs = []
+        for ids in prompt_ids:
+            try:
+                outputs.append(self.generate_responses([ids], greedy=greedy)[0])
+            except Exception as e:
+                outputs.append(e)
+        return outputs
+    
+    def process_batch(self, requests):
+        """
+        Audio → HuBERT → Llama 3 → Text for a batch of requests
         
         Args:
-            audio_path: Path to audio file (WAV format, 16kHz, mono)
-            context: Optional context about the conversation/course
+            requests: List of (audio_path, context, options) tuples, where options
+                may hold 'greedy' (bool) and 'on_partial' (callable for streaming)
         
         Returns:
-            dict with 'transcript' and 'response' keys
+            List of result dicts, one per request, in the same order. A request that
+            fails (unreadable audio, generation error) gets its own error result.
         """
-        if not self.models_loaded:
-            await self.load_models()
+        results = [None] * len(requests)
+        
+        def fail(i, error):
+            results[i] = {
+                'success': False,
+                'error': str(error)
+            }
         
         try:
-            # Step 1: Encode audio with HuBERT
-            print("🔊 Encoding audio with HuBERT...")
-            speech_tokens, speech_features = self.encode_audio_hubert(audio_path)
-            
-            # Step 2: Create prompt for Llama 3
-            prompt = self.create_speech_prompt(speech_tokens, context)
+            # Step 1: Encode all readable clips with one HuBERT forward pass
+            print(f"🔊 Encoding {len(requests)} audio clip(s) with HuBERT...")
+            speech_shape, load_errors = self.encode_audio_hubert(
+                [audio_path for audio_path, _, _ in requests]
+            )
+            for i, error in load_errors.items():
+                fail(i, error)
             
-            # Step 3: Generate response with Llama 3
-            print("🤖 Generating response with Llama 3...")
-            inputs = self.llama_tokenizer(prompt, return_tensors="pt").to(self.device)
+            pending = [i for i in range(len(requests)) if results[i] is None]
+            if not pending:
+                return results
+            _, speech_len, hidden_dim = speech_shape
             
-            with torch.no_grad():
-                outputs = self.llama_model.generate(
-                    **inputs,
-                    max_new_tokens=512,
-                    temperature=0.7,
-                    do_sample=True,
-                    top_p=0.9,
-                    pad_token_id=self.llama_tokenizer.eos_token_id
-                )
+            # Step 2: Create prompts for Llama 3
+            prompt_ids = {}
+            for i in pending:
+                try:
+                    prompt_ids[i] = self.create_speech_prompt(speech_len, requests[i][1])
+                except Exception as e:
+                    print(f"Error building prompt: {e}")
+                    fail(i, e)
+            pending = [i for i in pending if i in prompt_ids]
             
-            response_text = self.llama_tokenizer.decode(
-                outputs[0][inputs['input_ids'].shape[1]:],
-                skip_special_tokens=True
-            )
+            # Step 3: Generate responses with Llama 3. Streaming requests decode on
+            # their own; the rest share one generate() call per sampling mode.
+            print("🤖 Generating response(s) with Llama 3...")
+            response_texts = {}
+            for greedy in (False, True):
+                indices = [
+                    i for i in pending
+                    if not requests[i][2].get('on_partial')
+                    and bool(requests[i][2].get('greedy')) == greedy
+                ]
+                if indices:
+                    outputs = self.generate_isolated([prompt_ids[i] for i in indices], greedy=greedy)
+                    response_texts.update(zip(indices, outputs))
             
-            # Extract transcript and response from Llama output
-            # In practice, Llama would generate both transcription and response
-            transcript = response_text.split('\n')[0] if '\n' in response_text else response_text
-            response = response_text
+            for i in pending:
+                options = requests[i][2]
+                if options.get('on_partial'):
+                    try:
+                        response_texts[i] = self.generate_streaming(
+                            prompt_ids[i],
+                            options['on_partial'],
+                            greedy=bool(options.get('greedy'))
+                        )
+                    except Exception as e:
+                        response_texts[i] = e
             
-            return {
-                'success': True,
-                'transcript': transcript.strip(),
-                'response': response.strip(),
-                'speech_features_shape': speech_features.shape
-            }
+            for i in pending:
+                response_text = response_texts[i]
+                if isinstance(response_text, Exception):
+                    print(f"Error generating response: {response_text}")
+                    fail(i, response_text)
+                    continue
+                
+                # Extract transcript and response from Llama output
+                # In practice, Llama would generate both transcription and response
+                transcript = response_text.split('\n')[0] if '\n' in response_text else response_text
+                response = response_text
+                
+                results[i] = {
+                    'success': True,
+                    'transcript': transcript.strip(),
+                    'response': response.strip(),
+                    'speech_features_shape': (1, speech_len, hidden_dim)
+                }
+            return results
             
         except Exception as e:
-            print(f"Error in transcribe_and_understand: {e}")
+            print(f"Error in process_batch: {e}")
             import traceback
             traceback.print_exc()
-            return {
-                'success': False,
-                'error': str(e)
-            }
+            for i, result in enumerate(results):
+                if result is None:
+                    fail(i, e)
+            return results
+    
+    async def batch_worker(self):
+        """Drain queued transcribe requests into micro-batches and run them"""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await self.request_queue.get()]
+            
+            # Take whatever is already queued without waiting
+            while len(batch) < MAX_BATCH_SIZE and not self.request_queue.empty():
+                batch.append(self.request_queue.get_nowait())
+            
+            # Wait briefly for more requests so concurrent clients share a forward pass.
+            # handle_client awaits each transcribe, so a client has at most one request
+            # in flight; once every connected client is in the batch, nobody else can join.
+            deadline = loop.time() + MAX_BATCH_LATENCY
+            while len(batch) < min(MAX_BATCH_SIZE, len(self.clients)):
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.request_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            if not self.models_loaded:
+                await self.load_models()
+            
+            # Run inference off the event loop so clients keep being served
+            results = await loop.run_in_executor(
+                self.executor,
+                self.process_batch,
+                [(audio_path, context, options) for audio_path, context, options, _ in batch]
+            )
+            
+            for (_, _, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+    
+    async def transcribe_and_understand(self, audio_path, context="", greedy=False, on_partial=None):
+        """
+        Main function: Audio → HuBERT → Llama 3 → Text
+        
+        Queues the request for the batch worker and waits for its result.
+        
+        Args:
+            audio_path: Path to audio file (WAV format, 16kHz, mono)
+            context: Optional context about the conversation/course
+            greedy: Use deterministic greedy decoding instead of sampling
+            on_partial: Optional callable receiving response text chunks as they
+                are generated (called from the inference thread)
+        
+        Returns:
+            dict with 'transcript' and 'response' keys
+        """
+        future = asyncio.get_running_loop().create_future()
+        options = {'greedy': greedy, 'on_partial': on_partial}
+        await self.request_queue.put((audio_path, context, options, future))
+        return await future
     
     async def handle_client(self, websocket, path):
         """Handle WebSocket client connections"""
@@ -269,51 +679,67 @@ Please transcribe and understand the student's speech, then respond as a helpful
         try:
             async for message in websocket:
                 try:
-                    data = json.loads(message)
+                    data = orjson.loads(message)
                     msg_type = data.get('type')
                     
                     if msg_type == 'ping':
-                        await websocket.send(json.dumps({'type': 'pong'}))
+                        await websocket.send(to_json({'type': 'pong'}))
                     
                     elif msg_type == 'transcribe':
                         audio_path = data.get('audio_path')
-                        context = data.get('context', '')
+                        context = str(data.get('context') or '')  # Tokenized, so must be a string
                         
                         if not audio_path or not os.path.exists(audio_path):
-                            await websocket.send(json.dumps({
+                            await websocket.send(to_json({
                                 'type': 'error',
                                 'error': f'Audio file not found: {audio_path}'
                             }))
                             continue
                         
+                        # Optionally stream response text back as it is generated
+                        on_partial = None
+                        if data.get('stream'):
+                            loop = asyncio.get_running_loop()
+                            
+                            def on_partial(text, websocket=websocket, loop=loop):
+                                asyncio.run_coroutine_threadsafe(
+                                    websocket.send(to_json({'type': 'partial', 'text': text})),
+                                    loop
+                                )
+                        
                         # Process audio
-                        result = await self.transcribe_and_understand(audio_path, context)
+                        result = await self.transcribe_and_understand(
+                            audio_path,
+                            context,
+                            greedy=bool(data.get('greedy', False)),
+                            on_partial=on_partial
+                        )
                         
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             'type': 'result',
                             **result
                         }))
                     
                     elif msg_type == 'load_models':
                         success = await self.load_models()
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             'type': 'models_loaded',
                             'success': success
                         }))
                     
                     else:
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             'type': 'error',
                             'error': f'Unknown message type: {msg_type}'
                         }))
                         
-                except json.JSONDecodeError:
-                    await websocket.send(json.dumps({
+                except orjson.JSONDecodeError:
+                    await websocket.send(to_json({
                         'type': 'error',
                         'error': 'Invalid JSON'
                     }))
                 except Exception as e:
-                    await websocket.send(json.dumps({
+                    await websocket.send(to_json({
                         'type': 'error',
                         'error': str(e)
                     }))
@@ -324,10 +750,41 @@ Please transcribe and understand the student's speech, then respond as a helpful
             self.clients.remove(websocket)
             print(f"📡 Client disconnected. Remaining clients: {len(self.clients)}")
     
+    def warmup(self):
+        """
+        Run dummy HuBERT and Llama 3 passes so kernel autotuning, torch.compile
+        and CUDA graph capture happen before the first real request
+        """
+        try:
+            print("🔥 Warming up models...")
+            # The compiled CUDA model recompiles and records a CUDA graph per batch
+            # shape, so warm every size batch_worker can produce
+            batch_sizes = range(1, MAX_BATCH_SIZE + 1) if self.device == "cuda" else (1,)
+            for batch_size in batch_sizes:
+                if self._h2d_done is not None:
+                    self._h2d_done.synchronize()
+                self._audio_buf[:batch_size] = 0
+                self.run_hubert(batch_size)
+            self.generate_responses(
+                [self._prefix_ids + self._suffix_ids],
+                greedy=True,
+                max_new_tokens=4
+            )
+            print("✓ Warmup complete")
+        except Exception as e:
+            print(f"⚠ Warmup failed: {e}")
+    
     async def start_server(self, host='localhost', port=8766):
         """Start WebSocket server"""
+        # Load and warm models up front so the first request doesn't pay the cold start
+        if await self.load_models():
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.warmup)
+        
         print(f"🌐 Starting HuBERT + Llama 3 service on ws://{host}:{port}")
         
+        self.request_queue = asyncio.Queue()
+        self.batch_task = asyncio.create_task(self.batch_worker())
+        
         async with websockets.serve(self.handle_client, host, port):
             print("✅ Service ready. Waiting for connections...")
             await asyncio.Future()  # Run forever
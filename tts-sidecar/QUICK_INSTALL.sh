@@ -20,7 +20,7 @@ python3.10 --version
 if [ $? -eq 0 ]; then
     echo ""
     echo "📥 Installing Soprano TTS and dependencies..."
-    python3.10 -m pip install soprano-tts uvicorn
+    python3.10 -m pip install soprano-tts 'uvicorn[standard]'
     
     echo ""
     echo "✅ Installation complete!"
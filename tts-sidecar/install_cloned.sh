@@ -42,7 +42,7 @@ elif [ -f "setup.py" ]; then
     python3 -m pip install -e .
 else
     echo "⚠️  Could not find installation files. Installing dependencies manually..."
-    python3 -m pip install uvicorn requests
+    python3 -m pip install 'uvicorn[standard]' requests
 fi
 
 if [ $? -eq 0 ]; then
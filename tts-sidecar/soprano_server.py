@@ -34,5 +34,28 @@ if __name__ == "__main__":
     port = int(os.environ.get("SOPRANO_PORT", 8001))
     host = os.environ.get("SOPRANO_HOST", "127.0.0.1")
     
+    # Each worker process loads its own copy of the model
+    workers = int(os.environ.get("SOPRANO_WORKERS", 1))
+    
+    if workers > 1:
+        # Multiple workers need an import string, and the cloned repo on the workers' path
+        if os.path.exists(soprano_repo_path):
+            os.environ["PYTHONPATH"] = os.pathsep.join(
+                filter(None, [soprano_repo_path, os.environ.get("PYTHONPATH")])
+            )
+        target = "soprano.server:app"
+    else:
+        target = app
+    
     print(f"Starting Soprano TTS server on http://{host}:{port}")
-    uvicorn.run(app, host=host, port=port, log_level="info")
+    # uvicorn's "auto" loop/http pick uvloop + httptools when installed; no access log line per request.
+    # Log level stays at info so the app still sees the "Uvicorn running on" startup line.
+    uvicorn.run(
+        target,
+        host=host,
+        port=port,
+        log_level="info",
+        access_log=False,
+        workers=workers,
+        timeout_keep_alive=30
+    )
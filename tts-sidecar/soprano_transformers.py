@@ -5,19 +5,27 @@ Uses HuggingFace Transformers to run Soprano-1.1-80M model directly
 """
 import os
 import sys
+import asyncio
 import uvicorn
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import Response
 from pydantic import BaseModel
 import torch
-import torchaudio
+import numpy as np
+import soundfile
 import io
 
 # Global model loading
 pipe = None
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+# Dynamic batching of concurrent requests
+MAX_BATCH = 8
+MAX_BATCH_LATENCY_MS = 40  # How long to wait for more requests before synthesizing
+MAX_LENGTH_RATIO = 1.25  # Only batch texts within this length ratio (limits padding)
+request_queue = None
+
 class TTSRequest(BaseModel):
     input: str
     model: str = "ekwek/Soprano-1.1-80M"
@@ -40,22 +48,104 @@ def load_model():
         return True
     except ImportError:
         print("Error: transformers library not found")
-        print("  Install with: pip install transformers torch torchaudio")
+        print("  Install with: pip install transformers torch soundfile")
         return False
     except Exception as e:
         print(f"Error loading model: {e}")
         return False
 
+async def batch_worker():
+    """Collect concurrent TTS requests into batches and synthesize each batch in one pipeline call"""
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await request_queue.get()]
+        
+        # Wait briefly for more requests to share the forward pass
+        deadline = loop.time() + MAX_BATCH_LATENCY_MS / 1000
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(request_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        # Batch only similar-length texts so short requests don't wait on (and get
+        # padded out to) a much longer one
+        batch.sort(key=lambda item: len(item[0].input))
+        groups = [[batch[0]]]
+        for item in batch[1:]:
+            if len(item[0].input) > len(groups[-1][0][0].input) * MAX_LENGTH_RATIO:
+                groups.append([item])
+            else:
+                groups[-1].append(item)
+        
+        for group in groups:
+            await synthesize_group(loop, group)
+
+def trim_padding(audio):
+    """Drop the trailing exact-zero samples a batched pipeline call pads shorter outputs with"""
+    nonzero = np.flatnonzero(np.any(audio != 0, axis=0) if audio.ndim > 1 else audio)
+    end = nonzero[-1] + 1 if len(nonzero) else 0
+    return audio[..., :end]
+
+def synthesize(texts):
+    """
+    Run the pipeline on a batch of texts, isolating failures so one bad text only
+    fails its own request. Failed entries are returned as the exception raised.
+    """
+    if len(texts) > 1:
+        try:
+            # Batched outputs are padded to the longest one in the batch
+            return [
+                {**result, "audio": trim_padding(result["audio"])}
+                for result in pipe(texts, batch_size=len(texts))
+            ]
+        except Exception as e:
+            print(f"Batched synthesis failed ({e}), retrying texts one at a time")
+    
+    results = []
+    for text in texts:
+        try:
+            results.append(pipe(text))
+        except Exception as e:
+            results.append(e)
+    return results
+
+async def synthesize_group(loop, group):
+    """Synthesize one group of queued requests in a single pipeline call and resolve their futures"""
+    texts = [request.input for request, _ in group]
+    try:
+        # Run inference off the event loop so new requests keep queueing
+        results = await loop.run_in_executor(None, synthesize, texts)
+        for (_, future), result in zip(group, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+    except Exception as e:
+        # Never let an error escape into batch_worker, or every later request would hang
+        for _, future in group:
+            if not future.done():
+                future.set_exception(e)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Load model on server startup (using lifespan instead of deprecated on_event)"""
+    global request_queue
     # Startup
     if not load_model():
         print("⚠ Model not loaded - TTS requests will fail")
-        print("  Install dependencies: pip install transformers torch torchaudio")
+        print("  Install dependencies: pip install transformers torch soundfile")
+    request_queue = asyncio.Queue()
+    worker = asyncio.create_task(batch_worker())
     yield
-    # Shutdown (cleanup if needed)
-    pass
+    # Shutdown
+    worker.cancel()
 
 app = FastAPI(title="Soprano TTS (Transformers)", lifespan=lifespan)
 
@@ -70,33 +160,33 @@ async def text_to_speech(request: TTSRequest):
     if pipe is None:
         raise HTTPException(
             status_code=503,
-            detail="Soprano TTS model not loaded. Install dependencies: pip install transformers torch torchaudio"
+            detail="Soprano TTS model not loaded. Install dependencies: pip install transformers torch soundfile"
         )
     
     try:
         # Generate speech using Transformers pipeline
-        # The pipeline handles the model inference
-        result = pipe(request.input)
+        # Queued so concurrent requests are batched into one pipeline call
+        future = asyncio.get_running_loop().create_future()
+        await request_queue.put((request, future))
+        result = await future
         
         # Extract audio from result
         # Pipeline returns dict with 'audio' (numpy array) and 'sampling_rate'
         audio_array = result["audio"]
         sampling_rate = result.get("sampling_rate", 22050)
         
-        # Convert numpy array to torch tensor
-        audio_tensor = torch.from_numpy(audio_array)
-        
-        # Handle mono/stereo
-        if audio_tensor.dim() == 1:
-            audio_tensor = audio_tensor.unsqueeze(0)  # Add channel dimension
+        # Pipeline output is channels-first; soundfile expects frames-first
+        if audio_array.ndim > 1:
+            audio_array = audio_array.T
         
-        # Convert to WAV format
+        # Encode straight to 16-bit PCM WAV (single pass, no torch round trip)
         buffer = io.BytesIO()
-        torchaudio.save(
+        soundfile.write(
             buffer,
-            audio_tensor,
+            audio_array,
             sampling_rate,
-            format="wav"
+            format="WAV",
+            subtype="PCM_16"
         )
         buffer.seek(0)
         
@@ -127,6 +217,16 @@ if __name__ == "__main__":
     print(f"Starting Soprano TTS (Transformers) server on http://{host}:{port}")
     print(f"Using device: {device}")
     print(f"\nDependencies needed:")
-    print(f"  pip install transformers torch torchaudio fastapi uvicorn pydantic")
+    print(f"  pip install transformers torch soundfile fastapi 'uvicorn[standard]' pydantic")
     
-    uvicorn.run(app, host=host, port=port, log_level="info")
+    # uvicorn's "auto" loop/http pick uvloop + httptools when installed; no access log line per request.
+    # Log level stays at info so the app still sees the "Uvicorn running on" startup line.
+    uvicorn.run(
+        app,
+        host=host,
+        port=port,
+        log_level="info",
+        access_log=False,
+        workers=1,
+        timeout_keep_alive=30
+    )
@@ -8,7 +8,7 @@ Hey Libra, Hey Scorpio, Hey Sagittarius, Hey Capricorn, Hey Aquarius, Hey Pisces
 
 import asyncio
 import websockets
-import json
+import orjson
 import numpy as np
 import pyaudio
 import sys
@@ -29,12 +29,15 @@ PERSONAS = [
 ]
 
 WAKE_PHRASES = [f"Hey {persona}" for persona in PERSONAS]
+WAKE_PHRASE_KEYS = [phrase.lower().replace(' ', '_') for phrase in WAKE_PHRASES]  # Model output keys
 
 # Audio settings
 CHUNK = 1024
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
 RATE = 16000
+AUDIO_QUEUE_SIZE = 64  # Chunks buffered between the PyAudio thread and the event loop
+ONNX_THREADS = 2  # Intra-op threads for openWakeWord's ONNX Runtime sessions
 
 class WakeWordService:
     def __init__(self):
@@ -43,15 +46,24 @@ class WakeWordService:
         self.model = None
         self.audio = None
         self.stream = None
+        self.loop = None
+        self.audio_queue = None
         self.running = False
         self.oww_available = OWW_AVAILABLE  # Store as instance variable
+        self._f32 = np.empty(CHUNK, dtype=np.float32)  # Reused int16 -> float32 scratch buffer
         
         if OWW_AVAILABLE:
             try:
                 # Initialize openWakeWord with custom wake phrases
                 # Note: In production, you'd train custom models for each persona
                 # For now, we'll use keyword spotting or a simpler approach
-                self.model = Model(wakeword_models=['hey_aries'])
+                # ONNX Runtime (MLAS AVX2/AVX-512 kernels) for the melspectrogram,
+                # embedding and wake word models; ncpu sets the feature models' threads
+                self.model = Model(
+                    wakeword_models=['hey_aries'],
+                    inference_framework='onnx',
+                    ncpu=ONNX_THREADS
+                )
                 print("Wake word model loaded")
             except Exception as e:
                 print(f"Failed to load wake word model: {e}")
@@ -64,18 +76,24 @@ class WakeWordService:
         try:
             await websocket.wait_closed()
         finally:
-            self.clients.remove(websocket)
+            self.clients.discard(websocket)  # May already be dropped by a failed send
             print(f"Client disconnected. Total clients: {len(self.clients)}")
     
+    async def send_to_all(self, payload):
+        """Send a payload to all clients concurrently, dropping closed connections"""
+        clients = list(self.clients)
+        results = await asyncio.gather(
+            *(client.send(payload) for client in clients),
+            return_exceptions=True
+        )
+        self.clients -= {
+            client for client, result in zip(clients, results)
+            if isinstance(result, websockets.exceptions.ConnectionClosed)
+        }
+    
     async def broadcast(self, message):
         if self.clients:
-            disconnected = set()
-            for client in self.clients:
-                try:
-                    await client.send(json.dumps(message))
-                except websockets.exceptions.ConnectionClosed:
-                    disconnected.add(client)
-            self.clients -= disconnected
+            await self.send_to_all(orjson.dumps(message).decode())
     
     def detect_wake_word(self, audio_data):
         """Detect wake word in audio chunk"""
@@ -83,18 +101,22 @@ class WakeWordService:
             return None
         
         try:
-            # Convert bytes to numpy array
-            audio_array = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
+            # Convert bytes to normalized float32 in a single scaled cast into the scratch buffer
+            np.multiply(
+                np.frombuffer(audio_data, dtype=np.int16),
+                np.float32(1.0 / 32768.0),
+                out=self._f32,
+                casting='unsafe'
+            )
             
             # Run inference
-            prediction = self.model.predict(audio_array)
+            prediction = self.model.predict(self._f32)
             
             # Check for any wake phrase
-            for i, phrase in enumerate(WAKE_PHRASES):
+            for persona, key in zip(PERSONAS, WAKE_PHRASE_KEYS):
                 # In a real implementation, you'd check the model's output
                 # For now, this is a placeholder
-                if prediction.get(phrase.lower().replace(' ', '_'), 0) > 0.5:
-                    persona = PERSONAS[i]
+                if prediction.get(key, 0) > 0.5:
                     return persona
             
             return None
@@ -109,13 +131,17 @@ class WakeWordService:
             return
         
         try:
+            # PyAudio delivers chunks on its own thread; hand them to the event loop
+            self.loop = asyncio.get_running_loop()
+            self.audio_queue = asyncio.Queue(maxsize=AUDIO_QUEUE_SIZE)
             self.audio = pyaudio.PyAudio()
             self.stream = self.audio.open(
                 format=FORMAT,
                 channels=CHANNELS,
                 rate=RATE,
                 input=True,
-                frames_per_buffer=CHUNK
+                frames_per_buffer=CHUNK,
+                stream_callback=self.audio_callback
             )
             self.running = True
             print("Audio stream started")
@@ -123,52 +149,47 @@ class WakeWordService:
             print(f"Failed to start audio stream: {e}")
             self.running = False
     
+    def audio_callback(self, in_data, frame_count, time_info, status):
+        """PyAudio stream callback (runs on the PortAudio thread)"""
+        self.loop.call_soon_threadsafe(self.enqueue_audio, in_data)
+        return (None, pyaudio.paContinue)
+    
+    def enqueue_audio(self, audio_data):
+        """Queue a captured chunk, dropping the oldest one if detection falls behind"""
+        if self.audio_queue.full():
+            self.audio_queue.get_nowait()
+        self.audio_queue.put_nowait(audio_data)
+    
     async def audio_loop(self):
         """Process audio chunks for wake word detection"""
         if not self.running:
             return
         
+        loop = asyncio.get_running_loop()
         last_trigger_time = 0
         cooldown = 3.0  # Seconds between triggers
         
         while self.running:
             try:
-                if self.stream:
-                    audio_data = self.stream.read(CHUNK, exception_on_overflow=False)
-                    
-                    # Also stream to connected clients
-                    if self.clients:
-                        asyncio.create_task(self.broadcast_audio(audio_data))
-                    
-                    # Detect wake word
-                    persona = self.detect_wake_word(audio_data)
-                    if persona:
-                        import time
-                        current_time = time.time()
-                        if current_time - last_trigger_time > cooldown:
-                            last_trigger_time = current_time
-                            await self.broadcast({
-                                'triggered': True,
-                                'persona': persona
-                            })
-                            print(f"Wake word detected: {persona}")
+                audio_data = await self.audio_queue.get()
                 
-                await asyncio.sleep(0.01)  # Small delay to prevent CPU spinning
+                # Detect wake word
+                # ONNX Runtime releases the GIL, so inference runs off the event loop
+                persona = await loop.run_in_executor(None, self.detect_wake_word, audio_data)
+                if persona:
+                    import time
+                    current_time = time.time()
+                    if current_time - last_trigger_time > cooldown:
+                        last_trigger_time = current_time
+                        await self.broadcast({
+                            'triggered': True,
+                            'persona': persona
+                        })
+                        print(f"Wake word detected: {persona}")
             except Exception as e:
                 print(f"Audio loop error: {e}")
                 await asyncio.sleep(0.1)
     
-    async def broadcast_audio(self, audio_data):
-        """Broadcast audio data to clients (binary)"""
-        if self.clients:
-            disconnected = set()
-            for client in self.clients:
-                try:
-                    await client.send(audio_data)
-                except (websockets.exceptions.ConnectionClosed, TypeError):
-                    disconnected.add(client)
-            self.clients -= disconnected
-    
     def stop(self):
         """Stop audio stream"""
         self.running = False